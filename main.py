@@ -1,13 +1,48 @@
+from contextlib import asynccontextmanager
+import asyncio
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, ValidationError
 import httpx
-from bs4 import BeautifulSoup
+import redis.asyncio as redis
+from selectolax.lexbor import LexborHTMLParser
 import re
 from typing import Optional
+import functools
 import os
+import time
 
-app = FastAPI(title="Tarificateur Sectorem")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Client HTTP partagé : le pool de connexions est réutilisé entre les requêtes"""
+    app.state.http = httpx.AsyncClient(
+        timeout=30.0,
+        follow_redirects=True,
+        http2=True,
+        # Pages compressées en Brotli (paquet brotli) ou gzip : moins d'octets à transférer
+        headers={
+            "Accept-Encoding": "br, gzip",
+            "Accept-Language": "fr-FR,fr;q=0.9",
+            "User-Agent": "Sectorem-Tarificateur/1.0"
+        },
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=40, keepalive_expiry=30.0)
+    )
+    # Cache partagé entre workers si REDIS_URL est défini, sinon cache en mémoire du process
+    redis_url = os.getenv("REDIS_URL")
+    # Délais courts : un Redis injoignable doit se traduire par un cache manqué, pas par une requête bloquée
+    app.state.redis = redis.from_url(
+        redis_url,
+        decode_responses=True,
+        socket_connect_timeout=0.5,
+        socket_timeout=0.5
+    ) if redis_url else None
+    yield
+    await app.state.http.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+app = FastAPI(title="Tarificateur Sectorem", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Configuration CORS pour permettre les appels depuis le frontend
 app.add_middleware(
@@ -23,11 +58,17 @@ LUXIOR_ID = os.getenv("LUXIOR_ID", "443402")
 AMI3F_ID = os.getenv("AMI3F_ID", "9133")
 ODOO_API_KEY = os.getenv("ODOO_API_KEY", "")
 
+# Nettoyage des prix : on ne garde que les chiffres et les séparateurs
+_PRICE_STRIP = re.compile(r'[^\d,.]')
+
 class ProduitRequest(BaseModel):
     reference: str
     fournisseur: str  # "luxior" ou "ami3f"
 
 class ProduitResponse(BaseModel):
+    # Immuable : une même instance peut être partagée par le cache entre plusieurs requêtes
+    model_config = ConfigDict(frozen=True)
+    
     reference: str
     fournisseur: str
     prix: Optional[float] = None
@@ -35,6 +76,85 @@ class ProduitResponse(BaseModel):
     disponibilite: Optional[str] = None
     erreur: Optional[str] = None
 
+class RechercheTousRequest(BaseModel):
+    reference: str
+
+class ComparaisonResponse(BaseModel):
+    luxior: ProduitResponse
+    ami3f: ProduitResponse
+
+# Cache des tarifs : les prix fournisseurs ne changent pas d'une seconde à l'autre
+CACHE_TTL = int(os.getenv("CACHE_TTL", 300))
+CACHE_MAXSIZE = 10_000
+_cache: dict[tuple[str, str], tuple[float, ProduitResponse]] = {}
+_en_cours: dict[tuple[str, str], asyncio.Future] = {}
+
+async def _cache_lire(cle: tuple[str, str]) -> Optional[ProduitResponse]:
+    """Lit une réponse en cache (Redis si configuré, sinon mémoire locale)"""
+    if app.state.redis is not None:
+        try:
+            cached = await app.state.redis.get(f"tarif:{cle[0]}:{cle[1]}")
+        except redis.RedisError:
+            return None
+        if not cached:
+            return None
+        try:
+            return ProduitResponse.model_validate_json(cached)
+        except ValidationError:
+            # Entrée obsolète ou incompatible (ancien format) : traitée comme absente
+            return None
+    
+    entree = _cache.get(cle)
+    if entree and entree[0] > time.monotonic():
+        return entree[1]
+    return None
+
+async def _cache_ecrire(cle: tuple[str, str], resultat: ProduitResponse):
+    """Enregistre une réponse en cache pour CACHE_TTL secondes"""
+    if app.state.redis is not None:
+        try:
+            await app.state.redis.set(f"tarif:{cle[0]}:{cle[1]}", resultat.model_dump_json(), ex=CACHE_TTL)
+        except redis.RedisError:
+            pass
+        return
+    
+    _cache.pop(cle, None)
+    if len(_cache) >= CACHE_MAXSIZE:
+        # TTL constant : la première entrée est la plus ancienne
+        _cache.pop(next(iter(_cache)))
+    _cache[cle] = (time.monotonic() + CACHE_TTL, resultat)
+
+def cache_tarif(fournisseur: str):
+    """Met en cache les réponses réussies d'un scraper et regroupe les appels simultanés"""
+    def decorateur(scrape):
+        async def scrape_et_cache(cle: tuple[str, str], reference: str) -> ProduitResponse:
+            resultat = await scrape(reference)
+            
+            # Les erreurs ne sont pas mises en cache pour ne pas figer un échec passager
+            if resultat.erreur is None:
+                await _cache_ecrire(cle, resultat)
+            return resultat
+        
+        @functools.wraps(scrape)
+        async def wrapper(reference: str) -> ProduitResponse:
+            cle = (fournisseur, reference.strip().lower())
+            cached = await _cache_lire(cle)
+            if cached is not None:
+                return cached.model_copy(update={"reference": reference})
+            
+            # Une seule requête fournisseur par référence : les appels simultanés attendent la même tâche
+            tache = _en_cours.get(cle)
+            if tache is None:
+                tache = asyncio.ensure_future(scrape_et_cache(cle, reference))
+                _en_cours[cle] = tache
+                tache.add_done_callback(lambda _: _en_cours.pop(cle, None))
+            
+            # shield : l'annulation d'un appelant (client déconnecté) n'annule pas la tâche des autres
+            resultat = await asyncio.shield(tache)
+            return resultat.model_copy(update={"reference": reference})
+        return wrapper
+    return decorateur
+
 @app.get("/")
 async def root():
     return {
@@ -43,6 +163,7 @@ async def root():
         "endpoints": {
             "health": "/health",
             "recherche": "/api/recherche (POST)",
+            "recherche_tous": "/api/recherche-tous (POST)",
             "docs": "/docs"
         }
     }
@@ -56,64 +177,121 @@ async def health_check():
         "odoo_configured": bool(ODOO_API_KEY)
     }
 
+def _corps_html(response: httpx.Response):
+    """Corps de la page à passer au parseur, sans décodage intermédiaire quand c'est possible"""
+    # Lexbor lit directement les octets en UTF-8 ; pour un autre charset on passe par response.text
+    charset = (response.charset_encoding or "utf-8").lower()
+    return response.content if charset in ("utf-8", "utf8") else response.text
+
+def _parse_prix(prix_text: Optional[str]) -> Optional[float]:
+    """Convertit un prix affiché ("1 234,56 €") en float"""
+    if not prix_text:
+        return None
+    # Nettoyer le prix (enlever €, espaces, etc.)
+    prix_clean = _PRICE_STRIP.sub('', prix_text).replace(',', '.')
+    try:
+        return float(prix_clean)
+    except ValueError:
+        return None
+
+def _parse_luxior(body) -> Optional[tuple[str, Optional[float], str]]:
+    """Extrait (désignation, prix, disponibilité) d'une page de résultats Luxior"""
+    tree = LexborHTMLParser(body)
+    
+    # Recherche du produit dans les résultats
+    product_item = tree.css_first('div.product-item-info')
+    
+    if not product_item:
+        return None
+    
+    # Extraction du nom
+    name_element = product_item.css_first('a.product-item-link')
+    designation = name_element.text().strip() if name_element else "N/A"
+    
+    # Extraction du prix
+    price_element = product_item.css_first('span.price')
+    prix = _parse_prix(price_element.text().strip() if price_element else None)
+    
+    # Extraction de la disponibilité
+    stock_element = product_item.css_first('div.stock')
+    disponibilite = stock_element.text().strip() if stock_element else "À vérifier"
+    
+    return designation, prix, disponibilite
+
+def _parse_ami3f(body) -> Optional[tuple[str, Optional[float], str]]:
+    """Extrait (désignation, prix, disponibilité) d'une page de résultats AMI 3F"""
+    tree = LexborHTMLParser(body)
+    
+    # Recherche du produit (adapter selon la structure réelle du site)
+    product_card = tree.css_first('div.product-card')
+    
+    if not product_card:
+        # Essayer une autre structure
+        product_card = tree.css_first('article.product')
+    
+    if not product_card:
+        return None
+    
+    # Extraction du nom
+    name_element = product_card.css_first(
+        'h2[class*="product"][class*="title"], h3[class*="product"][class*="title"], '
+        'a[class*="product"][class*="title"], h2[class*="name"], h3[class*="name"], a[class*="name"]'
+    )
+    designation = name_element.text().strip() if name_element else "N/A"
+    
+    # Extraction du prix
+    price_element = product_card.css_first('span[class*="price"], div[class*="price"]')
+    prix = _parse_prix(price_element.text().strip() if price_element else None)
+    
+    # Extraction de la disponibilité
+    stock_element = product_card.css_first(
+        'span[class*="stock"], div[class*="stock"], span[class*="availability"], div[class*="availability"]'
+    )
+    disponibilite = stock_element.text().strip() if stock_element else "À vérifier"
+    
+    return designation, prix, disponibilite
+
+@cache_tarif("luxior")
 async def scrape_luxior(reference: str) -> ProduitResponse:
     """Scrape les données depuis Luxior"""
     try:
         url = f"https://www.luxior.fr/catalog/product/view/id/{LUXIOR_ID}"
         
-        async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-            # Première requête pour obtenir la page de recherche
-            search_url = f"https://www.luxior.fr/catalogsearch/result/?q={reference}"
-            response = await client.get(search_url)
-            
-            if response.status_code != 200:
-                return ProduitResponse(
-                    reference=reference,
-                    fournisseur="luxior",
-                    erreur=f"Erreur HTTP {response.status_code}"
-                )
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Recherche du produit dans les résultats
-            product_item = soup.find('div', class_='product-item-info')
-            
-            if not product_item:
-                return ProduitResponse(
-                    reference=reference,
-                    fournisseur="luxior",
-                    erreur="Produit non trouvé"
-                )
-            
-            # Extraction du nom
-            name_element = product_item.find('a', class_='product-item-link')
-            designation = name_element.text.strip() if name_element else "N/A"
-            
-            # Extraction du prix
-            price_element = product_item.find('span', class_='price')
-            prix_text = price_element.text.strip() if price_element else None
-            
-            prix = None
-            if prix_text:
-                # Nettoyer le prix (enlever €, espaces, etc.)
-                prix_clean = re.sub(r'[^\d,.]', '', prix_text).replace(',', '.')
-                try:
-                    prix = float(prix_clean)
-                except ValueError:
-                    pass
-            
-            # Extraction de la disponibilité
-            stock_element = product_item.find('div', class_='stock')
-            disponibilite = stock_element.text.strip() if stock_element else "À vérifier"
-            
+        client = app.state.http
+        # Première requête pour obtenir la page de recherche
+        search_url = "https://www.luxior.fr/catalogsearch/result/"
+        # La référence passe par params= : httpx se charge de l'encoder dans l'URL
+        params = {"q": reference}
+        response = await client.get(search_url, params=params)
+        
+        response.raise_for_status()
+        
+        # Le parsing est du CPU pur : on le sort de la boucle d'événements
+        produit = await asyncio.to_thread(_parse_luxior, _corps_html(response))
+        
+        if produit is None:
             return ProduitResponse(
                 reference=reference,
                 fournisseur="luxior",
-                prix=prix,
-                designation=designation,
-                disponibilite=disponibilite
+                erreur="Produit non trouvé"
             )
-            
+        
+        designation, prix, disponibilite = produit
+        
+        return ProduitResponse(
+            reference=reference,
+            fournisseur="luxior",
+            prix=prix,
+            designation=designation,
+            disponibilite=disponibilite
+        )
+        
+    except httpx.HTTPStatusError as e:
+        return ProduitResponse(
+            reference=reference,
+            fournisseur="luxior",
+            erreur=f"Erreur HTTP {e.response.status_code}"
+        )
     except httpx.TimeoutException:
         return ProduitResponse(
             reference=reference,
@@ -127,66 +305,44 @@ async def scrape_luxior(reference: str) -> ProduitResponse:
             erreur=f"Erreur: {str(e)}"
         )
 
+@cache_tarif("ami3f")
 async def scrape_ami3f(reference: str) -> ProduitResponse:
     """Scrape les données depuis AMI 3F"""
     try:
         # URL de recherche AMI 3F
-        search_url = f"https://www.ami3f.com/recherche?q={reference}"
+        search_url = "https://www.ami3f.com/recherche"
+        params = {"q": reference}
         
-        async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-            response = await client.get(search_url)
-            
-            if response.status_code != 200:
-                return ProduitResponse(
-                    reference=reference,
-                    fournisseur="ami3f",
-                    erreur=f"Erreur HTTP {response.status_code}"
-                )
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Recherche du produit (adapter selon la structure réelle du site)
-            product_card = soup.find('div', class_='product-card')
-            
-            if not product_card:
-                # Essayer une autre structure
-                product_card = soup.find('article', class_='product')
-            
-            if not product_card:
-                return ProduitResponse(
-                    reference=reference,
-                    fournisseur="ami3f",
-                    erreur="Produit non trouvé"
-                )
-            
-            # Extraction du nom
-            name_element = product_card.find(['h2', 'h3', 'a'], class_=re.compile('product.*title|name'))
-            designation = name_element.text.strip() if name_element else "N/A"
-            
-            # Extraction du prix
-            price_element = product_card.find(['span', 'div'], class_=re.compile('price'))
-            prix_text = price_element.text.strip() if price_element else None
-            
-            prix = None
-            if prix_text:
-                prix_clean = re.sub(r'[^\d,.]', '', prix_text).replace(',', '.')
-                try:
-                    prix = float(prix_clean)
-                except ValueError:
-                    pass
-            
-            # Extraction de la disponibilité
-            stock_element = product_card.find(['span', 'div'], class_=re.compile('stock|availability'))
-            disponibilite = stock_element.text.strip() if stock_element else "À vérifier"
-            
+        client = app.state.http
+        response = await client.get(search_url, params=params)
+        
+        response.raise_for_status()
+        
+        produit = await asyncio.to_thread(_parse_ami3f, _corps_html(response))
+        
+        if produit is None:
             return ProduitResponse(
                 reference=reference,
                 fournisseur="ami3f",
-                prix=prix,
-                designation=designation,
-                disponibilite=disponibilite
+                erreur="Produit non trouvé"
             )
-            
+        
+        designation, prix, disponibilite = produit
+        
+        return ProduitResponse(
+            reference=reference,
+            fournisseur="ami3f",
+            prix=prix,
+            designation=designation,
+            disponibilite=disponibilite
+        )
+        
+    except httpx.HTTPStatusError as e:
+        return ProduitResponse(
+            reference=reference,
+            fournisseur="ami3f",
+            erreur=f"Erreur HTTP {e.response.status_code}"
+        )
     except httpx.TimeoutException:
         return ProduitResponse(
             reference=reference,
@@ -219,6 +375,27 @@ async def recherche_produit(produit: ProduitRequest):
             detail="Fournisseur non supporté. Utilisez 'luxior' ou 'ami3f'"
         )
 
+@app.post("/api/recherche-tous", response_model=ComparaisonResponse)
+async def recherche_tous_fournisseurs(produit: RechercheTousRequest):
+    """Recherche un produit chez tous les fournisseurs en parallèle"""
+    
+    if not produit.reference or not produit.reference.strip():
+        raise HTTPException(status_code=400, detail="La référence est obligatoire")
+    
+    luxior, ami3f = await asyncio.gather(
+        scrape_luxior(produit.reference),
+        scrape_ami3f(produit.reference),
+        return_exceptions=True
+    )
+    
+    # Un échec chez un fournisseur ne doit pas masquer le résultat de l'autre
+    if isinstance(luxior, Exception):
+        luxior = ProduitResponse(reference=produit.reference, fournisseur="luxior", erreur=f"Erreur: {str(luxior)}")
+    if isinstance(ami3f, Exception):
+        ami3f = ProduitResponse(reference=produit.reference, fournisseur="ami3f", erreur=f"Erreur: {str(ami3f)}")
+    
+    return ComparaisonResponse(luxior=luxior, ami3f=ami3f)
+
 @app.get("/api/test-luxior/{reference}")
 async def test_luxior(reference: str):
     """Endpoint de test pour Luxior"""
@@ -232,4 +409,11 @@ async def test_ami3f(reference: str):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 1))
+    )